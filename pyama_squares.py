@@ -3,9 +3,16 @@ DOC = """© 2020 Daniel Woschée <daniel.woschee@physik.lmu.de>
 
 Create squared bounding boxes from cell contours.
 """
+from dataclasses import dataclass
+import itertools
+import math
 import os
 import pickle
+import re
+import secrets
+import shutil
 import sys
+import zipfile
 
 import numpy as np
 
@@ -24,6 +31,9 @@ RESOLUTIONS = {
         "10x_Zeiss": 1.546,
     }
 
+# Center coordinate of an empty ROI, as "x,y" in pixels
+_COORD_RE = re.compile(r'\s*([-+]?\d+)\s*,\s*([-+]?\d+)\s*')
+
 
 def read_bboxes(fn):
     """Read bounding boxes from a pickled file.
@@ -43,6 +53,211 @@ def read_bboxes(fn):
     return bboxes
 
 
+def write_bboxes(fn, bboxes):
+    """Write bounding boxes to a pickled file.
+
+    fn -- str, path of the pickled file
+    bboxes -- dict of bounding boxes in the format described in `read_bboxes`
+
+    The file is written with the highest pickle protocol available.
+    """
+    with open(fn, 'wb') as f:
+        pickle.dump(bboxes, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+_SOA_COORDS = ('x_min', 'x_max', 'y_min', 'y_max', 'x_mean', 'y_mean')
+
+# Suffix of the npz file with the struct-of-arrays bounding boxes
+SOA_SUFFIX = ".soa.npz"
+
+
+@dataclass
+class BBoxArrays:
+    """Bounding boxes stored as struct of arrays.
+
+    All arrays have the shape (n_rois, n_frames). The bounding box
+    coordinates 'x_min', 'x_max', 'y_min', 'y_max' are int32 arrays,
+    the centroid coordinates 'x_mean', 'y_mean' are float64 arrays.
+    `valid` is a bool array indicating which ROI has a bounding box
+    in which frame; coordinates of invalid entries are meaningless.
+    `width` and `height` are the image size in pixels, if known.
+    """
+    x_min: np.ndarray
+    x_max: np.ndarray
+    y_min: np.ndarray
+    y_max: np.ndarray
+    x_mean: np.ndarray
+    y_mean: np.ndarray
+    valid: np.ndarray
+    width: int = None
+    height: int = None
+
+    @property
+    def n_rois(self):
+        return self.valid.shape[0]
+
+    @property
+    def n_frames(self):
+        return self.valid.shape[1]
+
+
+def bboxes_to_soa(*bboxes, n_frames=None):
+    """Convert bounding boxes from dict to struct-of-arrays representation.
+
+    bboxes -- dicts of bounding boxes as returned by `read_bboxes`;
+              the ROIs of all dicts are combined, empty items are ignored
+    n_frames -- int, number of frames; by default taken from the first
+                special ROI `None` or, if missing, from the largest frame index
+
+    Bounding boxes with frame `None` are valid in all frames,
+    bounding boxes with frame `...` are ignored.
+    Since each ROI can have only one bounding box per frame, a ROI must
+    not have both a bounding box with frame `None` and bounding boxes
+    for single frames; a ValueError is raised in this case.
+
+    Returns an instance of `BBoxArrays`.
+    """
+    bboxes = [bbx for bbx in bboxes if bbx]
+    meta = next((bbx[None] for bbx in bboxes if bbx.get(None)), {})
+    rois = [tr for k, tr in itertools.chain.from_iterable(bbx.items() for bbx in bboxes) if k is not None]
+
+    rows = []
+    frames = []
+    values = []
+    for i, tr in enumerate(rois):
+        for fr, bb in tr.items():
+            if fr is ...:
+                continue
+            rows.append(i)
+            frames.append(-1 if fr is None else fr)
+            values.append([bb[name] for name in _SOA_COORDS])
+    rows = np.array(rows, dtype=np.intp)
+    frames = np.array(frames, dtype=np.intp)
+    values = np.array(values, dtype=np.float64).reshape(-1, len(_SOA_COORDS))
+
+    if n_frames is None:
+        n_frames = meta.get('n_frames')
+    if n_frames is None:
+        n_frames = frames.max(initial=-1) + 1
+
+    shape = (len(rois), n_frames)
+    all_frames = frames < 0
+    single_frame = ~all_frames
+    if np.intersect1d(rows[all_frames], rows[single_frame]).size:
+        raise ValueError("A ROI must not have both a bounding box for all frames and bounding boxes for single frames.")
+    arrays = {}
+    for j, name in enumerate(_SOA_COORDS):
+        if name.endswith('_mean'):
+            arr = np.zeros(shape, dtype=np.float64)
+        else:
+            arr = np.zeros(shape, dtype=np.int32)
+        arr[rows[all_frames], :] = values[all_frames, j, np.newaxis]
+        arr[rows[single_frame], frames[single_frame]] = values[single_frame, j]
+        arrays[name] = arr
+    valid = np.zeros(shape, dtype=bool)
+    valid[rows[all_frames], :] = True
+    valid[rows[single_frame], frames[single_frame]] = True
+
+    return BBoxArrays(valid=valid, width=meta.get('width'), height=meta.get('height'), **arrays)
+
+
+def _source_id(fn):
+    """Get the size and modification time in ns of a file"""
+    st = os.stat(fn)
+    return st.st_size, st.st_mtime_ns
+
+
+def write_soa(fn, soa, source=None):
+    """Write struct-of-arrays bounding boxes to an uncompressed npz file.
+
+    fn -- str, path of the npz file
+    soa -- `BBoxArrays` instance
+    source -- optional (size, mtime_ns) tuple of the file the bounding
+              boxes were read from, stored for checking by `read_soa`
+
+    The file is written to a temporary file first and then moved to `fn`,
+    so that an interrupted write does not leave a truncated file.
+    """
+    arrays = {name: getattr(soa, name) for name in (*_SOA_COORDS, 'valid')}
+    for name in ('width', 'height'):
+        if getattr(soa, name) is not None:
+            arrays[name] = getattr(soa, name)
+    if source is not None:
+        arrays['source'] = np.array(source, dtype=np.int64)
+    # Create the temporary file with `open` instead of `tempfile`,
+    # so that it gets the default permissions according to the umask
+    tmp_fn = f"{fn}.{os.getpid()}-{secrets.token_hex(4)}.tmp"
+    f = open(tmp_fn, 'xb')
+    try:
+        with f:
+            np.savez(f, **arrays)
+        os.replace(tmp_fn, fn)
+    except BaseException:
+        os.remove(tmp_fn)
+        raise
+
+
+def read_soa(fn, source=None):
+    """Read struct-of-arrays bounding boxes written by `write_soa`.
+
+    fn -- str, path of the npz file
+    source -- optional (size, mtime_ns) tuple; raise ValueError if it
+              differs from the one stored by `write_soa`
+
+    Returns an instance of `BBoxArrays`.
+    """
+    with np.load(fn, allow_pickle=False) as f:
+        if source is not None and ('source' not in f or tuple(f['source'].tolist()) != tuple(source)):
+            raise ValueError(f"File '{fn}' does not match its source file")
+        arrays = {name: f[name] for name in (*_SOA_COORDS, 'valid')}
+        for name in ('width', 'height'):
+            arrays[name] = int(f[name]) if name in f else None
+    return BBoxArrays(**arrays)
+
+
+def pickle_to_npz(fn):
+    """Convert a pickled bounding box file to struct-of-arrays npz.
+
+    The npz file is written next to the pickled file `fn` with the
+    suffix `SOA_SUFFIX` appended and can be read by `read_bboxes_fast`.
+    Returns the converted `BBoxArrays` instance.
+    """
+    source = _source_id(fn)
+    soa = bboxes_to_soa(read_bboxes(fn))
+    write_soa(fn + SOA_SUFFIX, soa, source=source)
+    return soa
+
+
+def read_bboxes_fast(fn, cache=True):
+    """Read bounding boxes as `BBoxArrays` instance.
+
+    fn -- str, path of the pickled file
+    cache -- bool, write the converted bounding boxes to an npz file
+             next to the pickled file (see `pickle_to_npz`)
+
+    If the npz file exists and was created from a pickled file of the
+    same size and modification time, the bounding boxes are read from
+    the npz file without constructing Python objects for the single
+    bounding boxes.
+    Else, or if the npz file cannot be read, the pickled file is read
+    and converted.
+    """
+    soa_fn = fn + SOA_SUFFIX
+    source = _source_id(fn)
+    try:
+        return read_soa(soa_fn, source=source)
+    except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+        pass
+
+    soa = bboxes_to_soa(read_bboxes(fn))
+    if cache:
+        try:
+            write_soa(soa_fn, soa, source=source)
+        except OSError as e:
+            print(f"Cannot write cache file '{soa_fn}': {e}", file=sys.stderr)
+    return soa
+
+
 def make_empty_bboxes(coords, area):
     """Create bounding boxes at given positions.
 
@@ -54,16 +269,16 @@ def make_empty_bboxes(coords, area):
     Returns a dict as required by the parameter `bboxes` of
     `varying_margins_centered`.
     """
-    w = np.rint(np.sqrt(area))
-    h = np.rint(area / w)
+    w = round(math.sqrt(area))
+    h = round(area / w)
     w2 = w // 2
     h2 = h // 2
     area = w * h
     
     bboxes = {}
     for i, c in enumerate(coords):
-        x1 = np.rint(c[0] - w2)
-        y1 = np.rint(c[1] - h2)
+        x1 = round(c[0] - w2)
+        y1 = round(c[1] - h2)
         x2 = x1 + w
         y2 = y1 + h
         bboxes[i] = {None: dict(
@@ -81,7 +296,7 @@ def make_empty_bboxes(coords, area):
 def insert_bb(stack, bb, bb_width=None, bb_height=None, frame=None, weighted=False, ignore_borders=False):
     """Insert a bounding box into a stack.
 
-    stack -- the numpy stack in which the bounding box is inserted; must have shape (n_frames, 1, 1, height, width)
+    stack -- the numpy stack in which the bounding box is inserted; must have shape (n_frames, height, width)
     bb -- dict of the bounding box; must have entries 'x_min', 'x_max', 'y_min', 'y_max'
     bb_width, bb_height -- int, optional arguments to overwrite bounding box size
     frame -- int, frame of `stack` to insert the bounding box; set `None` for all frames
@@ -97,13 +312,12 @@ def insert_bb(stack, bb, bb_width=None, bb_height=None, frame=None, weighted=Fal
         bb_width = w
     if bb_height is None:
         bb_height = h
-    if frame is None or frame is ...:
-        frame = slice(None)
+    all_frames = frame is None or frame is ...
 
     if weighted:
-        x1 = np.rint(bb['x_mean']).astype(int) - bb_width // 2
+        x1 = int(round(bb['x_mean'])) - bb_width // 2
         x2 = x1 + bb_width
-        y1 = np.rint(bb['y_mean']).astype(int) - bb_height // 2
+        y1 = int(round(bb['y_mean'])) - bb_height // 2
         y2 = y1 + bb_height
     else:
         x1 = bb['x_min'] - (bb_width - w) // 2
@@ -111,14 +325,11 @@ def insert_bb(stack, bb, bb_width=None, bb_height=None, frame=None, weighted=Fal
         y1 = bb['y_min'] - (bb_height - h) // 2
         y2 = y1 + bb_height
 
-    height, width = stack.shape[-2:]
-    if x1 < 0 or x2 > width or y1 < 0 or y2 > height:
-        if isinstance(frame, slice):
-            frame_name = ':'
-        elif isinstance(frame, type(...)):
-            frame_name = '...'
-        else:
-            frame_name = frame + 1
+    _, height, width = stack.shape
+    x1_clip, x2_clip = min(max(x1, 0), width), min(max(x2, 0), width)
+    y1_clip, y2_clip = min(max(y1, 0), height), min(max(y2, 0), height)
+    if (x1_clip, x2_clip, y1_clip, y2_clip) != (x1, x2, y1, y2):
+        frame_name = ':' if all_frames or isinstance(frame, slice) else frame + 1
         if ignore_borders:
             msg = "INCLUDE"
         else:
@@ -126,52 +337,228 @@ def insert_bb(stack, bb, bb_width=None, bb_height=None, frame=None, weighted=Fal
         print(f"{msg} box (x={x1}:{x2}, y={y1}:{y2})[{frame_name}] that hits border (w={bb_width}, h={bb_height})", file=sys.stderr)
         if not ignore_borders:
             return
-        if x1 < 0:
-            x1 = 0
-        if x2 > width:
-            x2 = width
-        if y1 < 0:
-            y1 = 0
-        if y2 > height:
-            y2 = height
         val = 2
     else:
         val = 1
-    stack[frame, ..., y1:y2, x1:x2] = val
+    if all_frames:
+        stack[:, y1_clip:y2_clip, x1_clip:x2_clip] = val
+    else:
+        stack[frame, y1_clip:y2_clip, x1_clip:x2_clip] = val
+
+
+def rasterize(stack, frame1, frame2, x1, x2, y1, y2, val):
+    """Write rectangles into a stack.
+
+    stack -- the numpy stack to write into; must have shape (n_frames, height, width)
+    frame1, frame2 -- int arrays, first and one-past-last frame of each rectangle
+    x1, x2, y1, y2 -- int arrays, rectangle bounds as slice indices; must lie in the image
+    val -- array of values to write into the rectangles
+
+    Rectangles are written in the given order, i.e. later rectangles
+    overwrite earlier ones where they overlap.
+    """
+    rects = zip(*(np.asarray(a).tolist() for a in (frame1, frame2, x1, x2, y1, y2, val)))
+    for fr1, fr2, xx1, xx2, yy1, yy2, v in rects:
+        stack[fr1:fr2, yy1:yy2, xx1:xx2] = v
+
+
+def rasterize_squares(stack, frame, x1, y1, length, val):
+    """Write squares of equal size into a stack at once.
+
+    stack -- the numpy stack to write into; must have shape (n_frames, height, width)
+    frame -- int array, frame of each square
+    x1, y1 -- int arrays, upper left corner of each square
+    length -- int, side length of the squares
+    val -- scalar value to write into the squares
+
+    All squares must lie completely in the image.
+    In contrast to `rasterize`, the squares are written by a single
+    fancy-indexed assignment into a view of all square windows of the
+    stack, which avoids a Python-level loop over the squares.
+    """
+    # The windows overlap in memory, which makes writing through them
+    # unsafe in general; since only a constant is written, the result
+    # does not depend on the order of the writes
+    windows = np.lib.stride_tricks.sliding_window_view(stack, (length, length), axis=(1, 2), writeable=True)
+    windows[frame, y1, x1] = val
+
+
+def _concat_soa(*bboxes, n_frames=None):
+    """Combine bounding boxes into one `BBoxArrays` instance.
+
+    bboxes -- dicts as returned by `read_bboxes` or `BBoxArrays` instances;
+              empty items are ignored
+    n_frames -- int, number of frames to use for dicts
+    """
+    soas = []
+    dicts = []
+    for bbx in bboxes:
+        if isinstance(bbx, BBoxArrays):
+            if dicts:
+                soas.append(bboxes_to_soa(*dicts, n_frames=n_frames))
+                dicts = []
+            soas.append(bbx)
+        elif bbx:
+            dicts.append(bbx)
+    if dicts or not soas:
+        soas.append(bboxes_to_soa(*dicts, n_frames=n_frames))
+    if len(soas) == 1:
+        return soas[0]
+    return BBoxArrays(**{name: np.concatenate([getattr(s, name) for s in soas])
+                         for name in (*_SOA_COORDS, 'valid')})
+
+
+def _square_length(margin, area):
+    """Get the side length of a square ROI with the given margin"""
+    return round(math.sqrt((1 + margin) * area))
+
+
+def _rasterize_squares(bb_length, x_center, y_center, valid, n_frames, height, width, ignore_borders):
+    """Make the stack of centered square ROIs of a given side length.
+
+    bb_length -- int, side length of the squares
+    x_center, y_center -- int arrays of shape (n_rois, n_frames), rounded ROI centroids
+    valid -- bool array of shape (n_rois, n_frames), see `BBoxArrays`
+
+    The other arguments are as in `varying_margins_centered`.
+    Returns the stack as array of shape (n_frames, height, width).
+    """
+    # np.zeros gets zeroed pages from the OS, which are only
+    # allocated physically when written
+    stack = np.zeros((n_frames, height, width), dtype=np.uint8)
+
+    x1 = x_center - bb_length // 2
+    x2 = x1 + bb_length
+    y1 = y_center - bb_length // 2
+    y2 = y1 + bb_length
+
+    # Merge consecutive frames of a ROI with identical boxes into runs
+    # to write them with a single slice assignment
+    new_run = np.ones(valid.shape, dtype=bool)
+    new_run[:, 1:] = ((valid[:, 1:] != valid[:, :-1]) |
+                      (x1[:, 1:] != x1[:, :-1]) |
+                      (y1[:, 1:] != y1[:, :-1]))
+    starts = np.flatnonzero(new_run)
+    stops = np.append(starts[1:], new_run.size)
+    is_box = valid.flat[starts]
+    starts, stops = starts[is_box], stops[is_box]
+    f1 = starts % n_frames
+    f2 = f1 + (stops - starts)
+    x1, x2, y1, y2 = x1.flat[starts], x2.flat[starts], y1.flat[starts], y2.flat[starts]
+
+    hit = (x1 < 0) | (x2 > width) | (y1 < 0) | (y2 > height)
+    if ignore_borders:
+        msg = "INCLUDE"
+    else:
+        msg = "EXCLUDE"
+    lines = []
+    for i in np.flatnonzero(hit):
+        if f1[i] == 0 and f2[i] == n_frames:
+            frame_name = ':'
+        elif f2[i] - f1[i] == 1:
+            frame_name = f1[i] + 1
+        else:
+            frame_name = f"{f1[i] + 1}-{f2[i]}"
+        lines.append(f"{msg} box (x={x1[i]}:{x2[i]}, y={y1[i]}:{y2[i]})[{frame_name}] that hits border (w={bb_length}, h={bb_length})\n")
+    # Write at once to avoid interleaving with messages of other threads
+    sys.stderr.write("".join(lines))
+
+    val = np.where(hit, 2, 1).astype(np.uint8)
+    draw = np.ones_like(hit) if ignore_borders else ~hit
+    x1, x2 = np.clip(x1, 0, width), np.clip(x2, 0, width)
+    y1, y2 = np.clip(y1, 0, height), np.clip(y2, 0, height)
+
+    f1, f2, x1, x2, y1, y2, val, hit = (a[draw] for a in (f1, f2, x1, x2, y1, y2, val, hit))
+    if not f1.size:
+        return stack
+    if hit.any() or not 1 <= bb_length <= min(height, width):
+        rasterize(stack, f1, f2, x1, x2, y1, y2, val)
+    else:
+        # All squares have full size; expand the runs to single frames
+        # and write all squares at once
+        n = f2 - f1
+        frame = np.repeat(f1 - np.cumsum(n) + n, n) + np.arange(n.sum())
+        rasterize_squares(stack, frame, np.repeat(x1, n), np.repeat(y1, n), bb_length, 1)
+    return stack
 
 
 def varying_margins_centered(area, *bboxes, margins=(0,), ignore_borders=False):
-    """Make binary npz stack with centered ROI and varying margins"""
-    n_frames = bboxes[0][None]['n_frames']
-    width = bboxes[0][None]['width']
-    height = bboxes[0][None]['height']
-    stacks = {}
-    for margin in margins:
-        stacks[margin] = np.zeros((n_frames, height, width), dtype=np.uint8)
-
-    for k, tr in (it for bbx in bboxes if bbx for it in bbx.items()):
-        if k is None:
-            continue
+    """Make binary npz stack with centered ROI and varying margins
+
+    The first item of `bboxes` must contain the metadata, i.e. be a dict
+    with the special ROI `None` (see `read_bboxes`) or a `BBoxArrays`
+    instance with known image size. The other items may be dicts,
+    `BBoxArrays` instances or `None`.
+
+    The stacks of different margins are created in parallel threads.
+    Margins resulting in the same square size share the same stack.
+    """
+    if isinstance(bboxes[0], BBoxArrays):
+        n_frames = bboxes[0].n_frames
+        width = bboxes[0].width
+        height = bboxes[0].height
+    else:
+        n_frames = bboxes[0][None]['n_frames']
+        width = bboxes[0][None]['width']
+        height = bboxes[0][None]['height']
+
+    soa = _concat_soa(*bboxes, n_frames=n_frames)
+    x_center = np.rint(soa.x_mean).astype(np.intp)
+    y_center = np.rint(soa.y_mean).astype(np.intp)
+    args = (x_center, y_center, soa.valid, n_frames, height, width, ignore_borders)
+
+    lengths = {margin: _square_length(margin, area) for margin in margins}
+    unique_lengths = set(lengths.values())
+    if len(unique_lengths) <= 1:
+        squares = {bb_length: _rasterize_squares(bb_length, *args) for bb_length in unique_lengths}
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(unique_lengths)) as ex:
+            futures = {bb_length: ex.submit(_rasterize_squares, bb_length, *args) for bb_length in unique_lengths}
+            squares = {bb_length: fut.result() for bb_length, fut in futures.items()}
+    return {margin: squares[bb_length] for margin, bb_length in lengths.items()}
 
-        for margin, stack in stacks.items():
-            x = 1 + margin
-            bb_length = np.rint(np.sqrt(x * area)).astype(int)
 
-            for fr, bb in tr.items():
-                if fr is ...:
-                    continue
-                insert_bb(stack, bb, bb_width=bb_length, bb_height=bb_length, frame=fr, weighted=True, ignore_borders=ignore_borders)
+def savez_compressed(fn, arr, compresslevel=6):
+    """Write an array to a compressed npz file.
+
+    fn -- str, path of the npz file
+    arr -- the array to write; stored as 'arr_0' like `np.savez_compressed`
+    compresslevel -- int, DEFLATE compression level from 0 to 9
+
+    In contrast to `np.savez_compressed`, which always uses level 6,
+    the compression level can be chosen. Label stacks are mostly zero,
+    so low levels are much faster at the cost of larger files.
+    """
+    with zipfile.ZipFile(fn, mode='w', compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zf:
+        with zf.open('arr_0.npy', mode='w', force_zip64=True) as f:
+            np.lib.format.write_array(f, np.asanyarray(arr), allow_pickle=False)
 
-    return stacks
 
+def _write_stack(stack, names, compresslevel):
+    """Write a stack to the first file name and copy it to the others"""
+    savez_compressed(names[0], stack, compresslevel=compresslevel)
+    for name in names[1:]:
+        shutil.copyfile(names[0], name)
 
-def export_squares(stacks, fn, outdir=None, verbose=False):
+
+def export_squares(stacks, fn, outdir=None, verbose=False, compresslevel=6, executor=None):
     """Write squares to npz files.
 
     stacks -- dict of stacks as generated by `varying margins_centered`
     fn -- str, path of input file, used for generating output file names
     outdir -- str, optional output directory other than input directory
     verbose -- bool, display file names?
+    compresslevel -- int, DEFLATE compression level from 0 to 9
+    executor -- optional `concurrent.futures.Executor` for writing the files
+
+    The stacks are compressed and written in parallel threads.
+    If `executor` is given, the writing tasks are submitted to it
+    and a list of futures is returned without waiting for them.
+    Else, a thread pool is created and all files are written on return.
+
+    Stacks shared by several margins are compressed only once
+    and copied to the file names of the other margins.
     """
     if outdir:
         os.makedirs(outdir, exist_ok=True)
@@ -179,11 +566,28 @@ def export_squares(stacks, fn, outdir=None, verbose=False):
         outdir = os.path.dirname(fn)
     name = os.path.splitext(os.path.basename(fn))[0]
 
+    # Group file names by stack; if margins result in the same
+    # file name, the last one wins
+    targets = {}
+    owners = {}
     for margin, stack in stacks.items():
         stack_name = f"{os.path.join(outdir, name)}_sqcenter_{1+margin :.0%}.npz"
         if verbose:
             print(f"Writing: {stack_name}")
-        np.savez_compressed(stack_name, stack)
+        if stack_name in owners:
+            targets[owners[stack_name]][1].remove(stack_name)
+        targets.setdefault(id(stack), (stack, []))[1].append(stack_name)
+        owners[stack_name] = id(stack)
+    targets = [(stack, names) for stack, names in targets.values() if names]
+
+    if executor is not None:
+        return [executor.submit(_write_stack, stack, names, compresslevel) for stack, names in targets]
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(4, len(targets)) or 1) as ex:
+        futures = [ex.submit(_write_stack, stack, names, compresslevel) for stack, names in targets]
+        for fut in futures:
+            fut.result()
 
 
 def make_epilog():
@@ -214,6 +618,9 @@ def parse_args():
     parser.add_argument('-b', '--ignore-borders', action='store_true', help="Do not exclude ROIs that hit the border.")
     parser.add_argument('-o', '--outdir', default=None, help="Output directory, if result files should not be written to same directory as input file.")
     parser.add_argument('-g', '--glob', action='store_true', help="Treat the given path(s) as Unix filename glob. May be helpful on Windows, where filenames are not expanded.")
+    parser.add_argument('-n', '--no-cache', action='store_true', help=f"Do not write the bounding boxes read from PATH to a cache file 'PATH{SOA_SUFFIX}'. By default, the cache file is written and used in later runs to speed up reading.")
+    parser.add_argument('-c', '--compress-level', type=int, default=6, choices=range(10), metavar="LEVEL", help="Compression level of the output files from 0 (no compression) to 9 (smallest files). Default is 6. Lower levels are faster, but result in larger files.")
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar="N", help="Number of input files to process in parallel. Default is 1; use 0 for the number of CPUs. Note that memory usage grows with the number of parallel jobs.")
     parser.add_argument('-s', '--silent', action='store_true', help="Suppress status output.")
     parser.add_argument('-x', '--empty', action='append', default=[], help="Insert a ROI centered at the given coordinate, e.g. to analyze an empty adhesion site. Specify the center as comma-separated list, e.g. '100,200' for x=100 and y=200 (in pixels). Multiple ROIs can be inserted by separating their coordinates with a semicolon or by specifying this option multiple times.")
     args = parser.parse_args()
@@ -259,36 +666,65 @@ def parse_args():
     argdict['area'] = area
     
     argdict['empty'] = []
-    for coord in (c for C in args.empty for c in C.split(';') if c):
-        cc = []
-        for csp in coord.split(','):
-            try:
-                cc.append(int(csp.strip()))
-            except Exception:
-                cc = None
-                break
-        else:
-            if len(cc) == 2:
-                argdict['empty'].append(cc)
-            else:
-                cc = None
-        if not cc:
+    for coord in itertools.chain.from_iterable(C.split(';') for C in args.empty):
+        if not coord:
+            continue
+        m = _COORD_RE.fullmatch(coord)
+        if not m:
             raise ValueError(f"Invalid coordinate '{coord}'. Coordinates must consist of two integers separated by a comma.")
+        argdict['empty'].append((int(m[1]), int(m[2])))
 
     argdict['ignore_borders'] = args.ignore_borders
     argdict['outdir'] = args.outdir
+    argdict['cache'] = not args.no_cache
+    argdict['compresslevel'] = args.compress_level
+    argdict['jobs'] = args.jobs
     argdict['verbose'] = not args.silent
 
     return argdict
 
 
-def main(path, area, margin, outdir=None, verbose=True, ignore_borders=False, empty=None):
-    for p in path:
-        bboxes = read_bboxes(p)
-        if empty:
-            empty = make_empty_bboxes(empty, area)
-        stacks = varying_margins_centered(area, bboxes, empty, margins=margin, ignore_borders=ignore_borders)
-        export_squares(stacks, p, outdir=outdir, verbose=verbose)
+def _process_one(p, area, margin, outdir, verbose, ignore_borders, empty, cache, compresslevel, writer=None):
+    """Create and export the squares for a single input file.
+
+    If `writer` is given, it is used as executor for writing the files
+    and the list of futures of the writing tasks is returned.
+    """
+    bboxes = read_bboxes_fast(p, cache=cache)
+    stacks = varying_margins_centered(area, bboxes, empty, margins=margin, ignore_borders=ignore_borders)
+    return export_squares(stacks, p, outdir=outdir, verbose=verbose, compresslevel=compresslevel, executor=writer)
+
+
+def main(path, area, margin, outdir=None, verbose=True, ignore_borders=False, empty=None, cache=True, compresslevel=6, jobs=1):
+    """Create squares for all input files.
+
+    `jobs` is the number of input files processed in parallel;
+    set `None` or 0 to use the number of CPUs.
+    """
+    if empty:
+        empty = make_empty_bboxes(empty, area)
+    if not jobs:
+        jobs = os.cpu_count()
+    jobs = min(jobs, len(path))
+
+    args = (area, margin, outdir, verbose, ignore_borders, empty, cache, compresslevel)
+    if jobs <= 1:
+        # Write the output of one file while processing the next one
+        from concurrent.futures import ThreadPoolExecutor
+        pending = []
+        with ThreadPoolExecutor(max_workers=4) as writer:
+            for p in path:
+                futures = _process_one(p, *args, writer=writer)
+                # Limit memory usage to the stacks of two files
+                for fut in pending:
+                    fut.result()
+                pending = futures
+            for fut in pending:
+                fut.result()
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as ex:
+            list(ex.map(_process_one, path, *(itertools.repeat(a) for a in args)))
 
 
 if __name__ == '__main__':